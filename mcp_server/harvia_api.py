@@ -1,17 +1,139 @@
 """Standalone Harvia Xenio WiFi API client (no Home Assistant dependency)."""
 
 import asyncio
-import json
+import base64
+import functools
 import logging
+import time
+from importlib import metadata
 
 import aiohttp
+import orjson
 from pycognito import Cognito
 
 REGION = "eu-west-1"
+try:
+    USER_AGENT = f"harvia-sauna-mcp/{metadata.version('harvia-sauna-mcp')}"
+except metadata.PackageNotFoundError:  # running from a source checkout
+    USER_AGENT = "harvia-sauna-mcp"
+
+# Refresh the Cognito tokens this many seconds before the id token expires.
+TOKEN_REFRESH_MARGIN = 60
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def _jwt_expiry(token: str) -> float:
+    """Return the ``exp`` claim of a JWT as a Unix timestamp."""
+    payload = token.split(".")[1]
+    payload += "=" * (-len(payload) % 4)
+    return float(orjson.loads(base64.urlsafe_b64decode(payload))["exp"])
+
+
+# -- GraphQL documents -------------------------------------------------------
+
+_DEVICE_STATE_FIELDS = "desired\n    reported\n    timestamp\n    __typename"
+_LATEST_DATA_FIELDS = (
+    "deviceId\n    timestamp\n    sessionId\n    type\n    data\n    __typename"
+)
+
+_QUERY_DEVICE_TREE = "query Query {\n  getDeviceTree\n}\n"
+
+_QUERY_DEVICE_STATE = (
+    "query Query($deviceId: ID!) {\n"
+    "  getDeviceState(deviceId: $deviceId) {\n"
+    f"    {_DEVICE_STATE_FIELDS}\n"
+    "  }\n}\n"
+)
+
+_QUERY_LATEST_DATA = (
+    "query Query($deviceId: String!) {\n"
+    "  getLatestData(deviceId: $deviceId) {\n"
+    f"    {_LATEST_DATA_FIELDS}\n"
+    "  }\n}\n"
+)
+
+_MUTATION_STATE_CHANGE = (
+    "mutation Mutation($deviceId: ID!, $state: AWSJSON!, $getFullState: Boolean) {\n"
+    "  requestStateChange(deviceId: $deviceId, state: $state, getFullState: $getFullState)\n"
+    "}\n"
+)
+
+# Pre-serialized request bodies. The getDeviceTree query takes no variables;
+# the requestStateChange template has %b slots for the JSON-encoded deviceId
+# and state (the query text itself contains no "%").
+_DEVICE_TREE_BODY = orjson.dumps(
+    {"operationName": "Query", "variables": {}, "query": _QUERY_DEVICE_TREE}
+)
+
+_STATE_CHANGE_BODY_TEMPLATE = (
+    b'{"operationName":"Mutation","variables":{"deviceId":%b,"state":%b,'
+    b'"getFullState":false},"query":' + orjson.dumps(_MUTATION_STATE_CHANGE) + b"}"
+)
+
+
+@functools.lru_cache(maxsize=32)
+def _aliased_query(
+    field: str, id_type: str, selection: str, count: int, extra: str = ""
+) -> str:
+    """Build a query selecting ``field`` once per device as aliases d0..dN.
+
+    ``extra`` is selected verbatim ahead of the aliased fields.
+    """
+    params = ", ".join(f"$d{i}: {id_type}" for i in range(count))
+    body = extra + "".join(
+        f"  d{i}: {field}(deviceId: $d{i}) {{\n    {selection}\n  }}\n"
+        for i in range(count)
+    )
+    return f"query Query({params}) {{\n{body}}}\n"
+
+
+@functools.lru_cache(maxsize=32)
+def _aliased_state_change(count: int) -> str:
+    """Build a mutation applying one state change to devices $d0..$dN."""
+    params = "".join(f"$d{i}: ID!, " for i in range(count))
+    body = "".join(
+        f"  m{i}: requestStateChange(deviceId: $d{i}, state: $state, "
+        "getFullState: $getFullState)\n"
+        for i in range(count)
+    )
+    return (
+        f"mutation Mutation({params}$state: AWSJSON!, $getFullState: Boolean) "
+        f"{{\n{body}}}\n"
+    )
+
+
+def _aliased_variables(query: str, device_ids: list[str]) -> dict:
+    return {
+        "operationName": "Query",
+        "variables": {f"d{i}": device_id for i, device_id in enumerate(device_ids)},
+        "query": query,
+    }
+
+
+def _parse_device_tree(data: dict) -> list[str]:
+    tree_data = orjson.loads(data["getDeviceTree"])
+    if not tree_data:
+        return []
+    return [node["i"]["name"] for node in tree_data[0]["c"]]
+
+
+def _parse_latest_data(item: dict) -> dict:
+    data = orjson.loads(item["data"])
+    data["timestamp"] = item["timestamp"]
+    data["type"] = item["type"]
+    return data
+
+
+def _merge_devices(
+    device_ids: list[str], states: list[dict], latest: list[dict]
+) -> list[dict]:
+    return [
+        {**state, **data, "deviceId": device_id}
+        for device_id, state, data in zip(device_ids, states, latest)
+    ]
+
+
 class HarviaClient:
     """Async client for the Harvia cloud API (MyHarvia backend)."""
 
@@ -21,13 +143,17 @@ class HarviaClient:
         self._session: aiohttp.ClientSession | None = None
         self._endpoints: dict | None = None
         self._cognito: Cognito | None = None
-        self._token_data: dict | None = None
+        self._id_token_str: str | None = None
+        self._token_expiry: float = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._device_ids_cache: tuple[list[str], float] | None = None
+        self._device_ids_lock = asyncio.Lock()
 
     # -- lifecycle -----------------------------------------------------------
 
     async def connect(self) -> None:
         """Create HTTP session, discover endpoints, and authenticate."""
-        self._session = aiohttp.ClientSession()
+        self._get_session()
         await self._fetch_endpoints()
         await self._authenticate()
 
@@ -37,14 +163,34 @@ class HarviaClient:
             await self._session.close()
             self._session = None
 
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, recreating it if it was closed."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=16,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30, connect=10),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                headers={"User-Agent": USER_AGENT},
+            )
+        return self._session
+
     # -- endpoint discovery --------------------------------------------------
 
+    async def _fetch_endpoint(self, name: str) -> dict:
+        url = f"https://prod.myharvia-cloud.net/{name}/endpoint"
+        async with self._get_session().get(url) as resp:
+            return await resp.json()
+
     async def _fetch_endpoints(self) -> None:
-        self._endpoints = {}
-        for name in ("users", "device", "events", "data"):
-            url = f"https://prod.myharvia-cloud.net/{name}/endpoint"
-            async with self._session.get(url) as resp:
-                self._endpoints[name] = await resp.json()
+        names = ("users", "device", "events", "data")
+        results = await asyncio.gather(*(self._fetch_endpoint(n) for n in names))
+        self._endpoints = dict(zip(names, results))
 
     # -- cognito auth --------------------------------------------------------
 
@@ -65,111 +211,199 @@ class HarviaClient:
         return self._cognito
 
     async def _authenticate(self) -> None:
-        if self._token_data is not None:
+        if self._id_token_str is not None:
             return
         client = await self._get_cognito()
         await asyncio.to_thread(client.authenticate, password=self.password)
-        self._token_data = {
-            "access_token": client.access_token,
-            "refresh_token": client.refresh_token,
-            "id_token": client.id_token,
-        }
+        self._store_tokens(client)
+
+    def _store_tokens(self, client: Cognito) -> None:
+        # Access and refresh tokens stay on the Cognito instance; only the id
+        # token is sent with requests.
+        self._id_token_str = client.id_token
+        self._token_expiry = _jwt_expiry(client.id_token)
+
+    def _token_stale(self) -> bool:
+        return time.time() > self._token_expiry - TOKEN_REFRESH_MARGIN
 
     async def _refresh_tokens(self) -> None:
-        client = await self._get_cognito()
-        await self._authenticate()
-        await asyncio.to_thread(client.check_token, renew=True)
-        self._token_data = {
-            "access_token": client.access_token,
-            "refresh_token": client.refresh_token,
-            "id_token": client.id_token,
-        }
+        # Only reached near expiry, so skip check_token's own expiry decode
+        # and renew with the Cognito instance built at login.
+        await asyncio.to_thread(self._cognito.renew_access_token)
+        self._store_tokens(self._cognito)
 
     async def _id_token(self) -> str:
-        await self._refresh_tokens()
-        return self._token_data["id_token"]
+        """Slow path: refresh the tokens under the lock and return the id token."""
+        async with self._refresh_lock:
+            # Another caller may have refreshed while we waited on the lock.
+            if self._token_stale():
+                await self._refresh_tokens()
+        return self._id_token_str
 
     # -- low-level GraphQL ---------------------------------------------------
 
-    async def _post(self, endpoint_key: str, query: dict) -> dict:
-        """POST a GraphQL query/mutation to the specified AppSync endpoint."""
-        token = await self._id_token()
-        headers = {"authorization": token}
+    async def _post(self, endpoint_key: str, query: dict | bytes) -> dict:
+        """POST a GraphQL query/mutation to the specified AppSync endpoint.
+
+        ``query`` may be a dict or an already JSON-encoded body.
+        """
+        token = self._id_token_str
+        if self._token_stale():
+            token = await self._id_token()
+        headers = {"authorization": token, "content-type": "application/json"}
+        body = query if isinstance(query, bytes) else orjson.dumps(query)
         url = self._endpoints[endpoint_key]["endpoint"]
-        async with self._session.post(url, json=query, headers=headers) as resp:
-            return await resp.json()
+        session = self._get_session()
+        async with session.post(url, data=body, headers=headers) as resp:
+            return await resp.json(loads=orjson.loads)
 
     # -- public API methods --------------------------------------------------
 
+    async def _fetch_device_ids(self) -> list[str]:
+        """Query the device tree (getDeviceTree) and refresh the ID cache."""
+        tree_resp = await self._post("device", _DEVICE_TREE_BODY)
+        device_ids = _parse_device_tree(tree_resp["data"])
+        self._device_ids_cache = (device_ids, time.monotonic())
+        return device_ids
+
+    async def list_device_ids(self, max_age: float = 60.0) -> list[str]:
+        """Return the account's device IDs, cached for up to ``max_age`` seconds."""
+        device_ids = self._cached_device_ids(max_age)
+        if device_ids is not None:
+            return device_ids
+        async with self._device_ids_lock:
+            # Another caller may have refetched while we waited on the lock.
+            device_ids = self._cached_device_ids(max_age)
+            if device_ids is not None:
+                return device_ids
+            return await self._fetch_device_ids()
+
+    def _cached_device_ids(self, max_age: float) -> list[str] | None:
+        if self._device_ids_cache is None:
+            return None
+        device_ids, fetched_at = self._device_ids_cache
+        if time.monotonic() - fetched_at < max_age:
+            return device_ids
+        return None
+
+    async def _fetch_device_tree_and_states(
+        self, device_ids: list[str]
+    ) -> tuple[list[str], list[dict]]:
+        """Fetch the device tree and the states of ``device_ids`` in one query.
+
+        The states are only parsed when the tree still matches ``device_ids``;
+        otherwise an empty list is returned alongside the new tree.
+        """
+        query = _aliased_query(
+            "getDeviceState",
+            "ID!",
+            _DEVICE_STATE_FIELDS,
+            len(device_ids),
+            extra="  getDeviceTree\n",
+        )
+        resp = await self._post("device", _aliased_variables(query, device_ids))
+        data = resp["data"]
+        tree_ids = _parse_device_tree(data)
+        if tree_ids != device_ids:
+            return tree_ids, []
+        states = [orjson.loads(data[f"d{i}"]["reported"]) for i in range(len(device_ids))]
+        return tree_ids, states
+
     async def list_devices(self) -> list[dict]:
         """Return a list of device dicts with full state + latest data merged."""
-        tree_query = {
-            "operationName": "Query",
-            "variables": {},
-            "query": "query Query {\n  getDeviceTree\n}\n",
-        }
-        tree_resp = await self._post("device", tree_query)
-        tree_data = json.loads(tree_resp["data"]["getDeviceTree"])
-        if not tree_data:
+        known_ids = self._device_ids_cache[0] if self._device_ids_cache else []
+        if known_ids:
+            # Re-read the tree alongside the states of the devices already
+            # cached, so the usual case is one request per endpoint. If a
+            # cached device was removed, either query can come back with null
+            # fields (KeyError/TypeError while parsing). Any other failure is a
+            # real error and propagates.
+            fused, latest = await asyncio.gather(
+                self._fetch_device_tree_and_states(known_ids),
+                self.get_latest_data_many(known_ids),
+                return_exceptions=True,
+            )
+            for result in (fused, latest):
+                if isinstance(result, BaseException) and not isinstance(
+                    result, (KeyError, TypeError)
+                ):
+                    raise result
+            if isinstance(fused, Exception):
+                # The tree itself could not be read; fetch it on its own.
+                self._device_ids_cache = None
+                device_ids = await self._fetch_device_ids()
+            else:
+                device_ids, states = fused
+                self._device_ids_cache = (device_ids, time.monotonic())
+                if device_ids == known_ids and not isinstance(latest, Exception):
+                    return _merge_devices(device_ids, states, latest)
+                # The tree changed: reuse it for the per-device round below.
+        else:
+            device_ids = await self._fetch_device_ids()
+        if not device_ids:
             return []
 
-        devices = []
-        for node in tree_data[0]["c"]:
-            device_id = node["i"]["name"]
-            state = await self.get_device_state(device_id)
-            latest = await self.get_latest_data(device_id)
-            merged = {**state, **latest, "deviceId": device_id}
-            devices.append(merged)
-        return devices
+        states, latest = await asyncio.gather(
+            self.get_device_states(device_ids),
+            self.get_latest_data_many(device_ids),
+        )
+        return _merge_devices(device_ids, states, latest)
 
     async def get_device_state(self, device_id: str) -> dict:
         """Fetch the reported device state (getDeviceState)."""
         query = {
             "operationName": "Query",
             "variables": {"deviceId": device_id},
-            "query": (
-                "query Query($deviceId: ID!) {\n"
-                "  getDeviceState(deviceId: $deviceId) {\n"
-                "    desired\n    reported\n    timestamp\n    __typename\n"
-                "  }\n}\n"
-            ),
+            "query": _QUERY_DEVICE_STATE,
         }
         resp = await self._post("device", query)
-        return json.loads(resp["data"]["getDeviceState"]["reported"])
+        return orjson.loads(resp["data"]["getDeviceState"]["reported"])
+
+    async def get_device_states(self, device_ids: list[str]) -> list[dict]:
+        """Fetch the reported state of several devices in one aliased query."""
+        query = _aliased_query(
+            "getDeviceState", "ID!", _DEVICE_STATE_FIELDS, len(device_ids)
+        )
+        resp = await self._post("device", _aliased_variables(query, device_ids))
+        data = resp["data"]
+        return [orjson.loads(data[f"d{i}"]["reported"]) for i in range(len(device_ids))]
 
     async def get_latest_data(self, device_id: str) -> dict:
         """Fetch the latest sensor/runtime data (getLatestData)."""
         query = {
             "operationName": "Query",
             "variables": {"deviceId": device_id},
-            "query": (
-                "query Query($deviceId: String!) {\n"
-                "  getLatestData(deviceId: $deviceId) {\n"
-                "    deviceId\n    timestamp\n    sessionId\n    type\n    data\n"
-                "    __typename\n"
-                "  }\n}\n"
-            ),
+            "query": _QUERY_LATEST_DATA,
         }
         resp = await self._post("data", query)
-        item = resp["data"]["getLatestData"]
-        data = json.loads(item["data"])
-        data["timestamp"] = item["timestamp"]
-        data["type"] = item["type"]
-        return data
+        return _parse_latest_data(resp["data"]["getLatestData"])
+
+    async def get_latest_data_many(self, device_ids: list[str]) -> list[dict]:
+        """Fetch the latest data of several devices in one aliased query."""
+        query = _aliased_query(
+            "getLatestData", "String!", _LATEST_DATA_FIELDS, len(device_ids)
+        )
+        resp = await self._post("data", _aliased_variables(query, device_ids))
+        data = resp["data"]
+        return [_parse_latest_data(data[f"d{i}"]) for i in range(len(device_ids))]
 
     async def send_state_change(self, device_id: str, payload: dict) -> dict:
         """Send a requestStateChange mutation."""
+        state = orjson.dumps(payload).decode()
+        body = _STATE_CHANGE_BODY_TEMPLATE % (
+            orjson.dumps(device_id),
+            orjson.dumps(state),
+        )
+        return await self._post("device", body)
+
+    async def send_state_change_many(self, device_ids: list[str], payload: dict) -> dict:
+        """Send the same requestStateChange to several devices in one mutation."""
+        variables: dict = {f"d{i}": device_id for i, device_id in enumerate(device_ids)}
+        variables["state"] = orjson.dumps(payload).decode()
+        variables["getFullState"] = False
         query = {
             "operationName": "Mutation",
-            "variables": {
-                "deviceId": device_id,
-                "state": json.dumps(payload),
-                "getFullState": False,
-            },
-            "query": (
-                "mutation Mutation($deviceId: ID!, $state: AWSJSON!, $getFullState: Boolean) {\n"
-                "  requestStateChange(deviceId: $deviceId, state: $state, getFullState: $getFullState)\n"
-                "}\n"
-            ),
+            "variables": variables,
+            "query": _aliased_state_change(len(device_ids)),
         }
         return await self._post("device", query)
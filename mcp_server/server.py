@@ -1,5 +1,7 @@
 """MCP server exposing Harvia Xenio WiFi sauna controls as tools."""
 
+import asyncio
+import functools
 import os
 import logging
 from contextlib import asynccontextmanager
@@ -39,10 +41,16 @@ mcp = FastMCP("Harvia Sauna", lifespan=_lifespan)
 # ---------------------------------------------------------------------------
 
 def _c_to_f(celsius: float) -> float:
+    if isinstance(celsius, int):
+        # Exact in tenths of a degree: F * 10 = C * 18 + 320.
+        return (celsius * 18 + 320) / 10
     return round(celsius * 9 / 5 + 32, 1)
 
 
-def _f_to_c(fahrenheit: float) -> float:
+def _f_to_c(fahrenheit: float) -> int:
+    if isinstance(fahrenheit, int) or fahrenheit.is_integer():
+        # (F - 32) * 5 / 9 rounded; ninths never tie, so +4 rounds half up.
+        return (int(fahrenheit) * 5 - 156) // 9
     return round((fahrenheit - 32) * 5 / 9)
 
 
@@ -51,22 +59,41 @@ async def _resolve_device_id(ctx, device_id: str | None) -> str:
     if device_id:
         return device_id
     client: HarviaClient = ctx.request_context.lifespan_context["client"]
-    devices = await client.list_devices()
-    if not devices:
+    device_ids = await client.list_device_ids()
+    if not device_ids:
         raise ValueError("No sauna devices found on this account")
-    return devices[0]["deviceId"]
+    return device_ids[0]
+
+
+@functools.lru_cache(maxsize=128)
+def _door_from_statuscodes(status_codes: int | str) -> str:
+    """Door state from statusCodes: 2nd digit == 9 means open."""
+    if isinstance(status_codes, int) and status_codes >= 10:
+        # Second-most-significant digit, without formatting to a string.
+        door_digit = status_codes
+        while door_digit >= 100:
+            door_digit //= 10
+        door_digit %= 10
+    else:
+        door_digit = int(str(status_codes)[1])
+    return "open" if door_digit == 9 else "closed"
+
+
+# Keys present in every status dict, in output order.
+_STATUS_TEMPLATE = dict.fromkeys(
+    ("device_id", "name", "power", "lights", "fan", "steamer")
+)
 
 
 def _format_status(device: dict) -> dict:
     """Build a human-friendly status dict from raw device data."""
-    status: dict = {
-        "device_id": device.get("deviceId"),
-        "name": device.get("displayName"),
-        "power": "on" if device.get("active") or device.get("heatOn") else "off",
-        "lights": "on" if device.get("light") else "off",
-        "fan": "on" if device.get("fan") else "off",
-        "steamer": "on" if device.get("steamEn") or device.get("steamOn") else "off",
-    }
+    status = _STATUS_TEMPLATE.copy()
+    status["device_id"] = device.get("deviceId")
+    status["name"] = device.get("displayName")
+    status["power"] = "on" if device.get("active") or device.get("heatOn") else "off"
+    status["lights"] = "on" if device.get("light") else "off"
+    status["fan"] = "on" if device.get("fan") else "off"
+    status["steamer"] = "on" if device.get("steamEn") or device.get("steamOn") else "off"
 
     target_c = device.get("targetTemp")
     if target_c is not None:
@@ -92,8 +119,7 @@ def _format_status(device: dict) -> dict:
 
     status_codes = device.get("statusCodes")
     if status_codes is not None:
-        door_digit = int(str(status_codes)[1])
-        status["door"] = "open" if door_digit == 9 else "closed"
+        status["door"] = _door_from_statuscodes(status_codes)
 
     return status
 
@@ -123,8 +149,9 @@ async def get_sauna_status(ctx, device_id: str | None = None) -> dict:
     client: HarviaClient = ctx.request_context.lifespan_context["client"]
     try:
         did = await _resolve_device_id(ctx, device_id)
-        state = await client.get_device_state(did)
-        latest = await client.get_latest_data(did)
+        state, latest = await asyncio.gather(
+            client.get_device_state(did), client.get_latest_data(did)
+        )
         merged = {**state, **latest, "deviceId": did}
         return _format_status(merged)
     except Exception as e:
@@ -148,14 +175,26 @@ async def turn_sauna_on(ctx, device_id: str | None = None) -> dict:
 
 
 @mcp.tool()
-async def turn_sauna_off(ctx, device_id: str | None = None) -> dict:
+async def turn_sauna_off(
+    ctx, device_id: str | None = None, all_devices: bool = False
+) -> dict:
     """Turn the sauna heater OFF.
 
     Args:
         device_id: Device ID. Omit to use the first device.
+        all_devices: True to turn off every device on the account. Cannot be
+            combined with device_id.
     """
     client: HarviaClient = ctx.request_context.lifespan_context["client"]
     try:
+        if all_devices and device_id:
+            return {"error": "Pass either device_id or all_devices, not both"}
+        if all_devices:
+            device_ids = await client.list_device_ids()
+            if not device_ids:
+                raise ValueError("No sauna devices found on this account")
+            await client.send_state_change_many(device_ids, {"active": 0})
+            return {"status": "ok", "device_ids": device_ids, "power": "off"}
         did = await _resolve_device_id(ctx, device_id)
         await client.send_state_change(did, {"active": 0})
         return {"status": "ok", "device_id": did, "power": "off"}